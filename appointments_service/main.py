@@ -7,13 +7,14 @@ import os
 from datetime import datetime, timedelta
 import json
 import logging
-from sqlalchemy import create_engine, Column, String, DateTime, Boolean, Text, Integer, JSON
+from sqlalchemy import create_engine, event, Column, String, DateTime, Boolean, Text, Integer, JSON
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.dialects.postgresql import UUID
 import uuid
 from pydantic import BaseModel
 import aioredis
+from cachetools import TTLCache
 from celery import Celery
 import smtplib
 from email.mime.text import MimeText
@@ -87,6 +88,33 @@ class Notification(Base):
 # Crear tablas
 Base.metadata.create_all(bind=engine)
 
+# Caché en memoria de plantillas: cambian poco y se consultan en cada envío
+template_cache = TTLCache(maxsize=256, ttl=300)
+
+def get_template(db: Session, template_type: str, channel: str) -> Optional[NotificationTemplate]:
+    """Obtener plantilla activa por tipo y canal, usando la caché en memoria"""
+    key = (template_type, channel)
+    template = template_cache.get(key)
+    if template is None:
+        template = db.query(NotificationTemplate).filter(
+            NotificationTemplate.template_type == template_type,
+            NotificationTemplate.channel == channel,
+            NotificationTemplate.is_active == True
+        ).first()
+        if template:
+            # Desvincular de la sesión para que el commit no expire sus atributos
+            db.expunge(template)
+            template_cache[key] = template
+    return template
+
+@event.listens_for(NotificationTemplate, "after_insert")
+@event.listens_for(NotificationTemplate, "after_update")
+@event.listens_for(NotificationTemplate, "after_delete")
+def invalidate_template_cache(mapper, connection, target):
+    # Vaciar todo: un cambio de tipo o canal deja obsoleta también la clave anterior,
+    # y las plantillas casi nunca cambian
+    template_cache.clear()
+
 # Dependency para obtener sesión de DB
 def get_db():
     db = SessionLocal()
@@ -342,11 +370,7 @@ async def send_notification(
 ):
     """Enviar una notificación"""
     # Buscar template
-    template = db.query(NotificationTemplate).filter(
-        NotificationTemplate.template_type == request.template_type,
-        NotificationTemplate.channel == request.channel,
-        NotificationTemplate.is_active == True
-    ).first()
+    template = get_template(db, request.template_type, request.channel)
     
     if not template:
         raise HTTPException(status_code=404, detail="Template no encontrado")
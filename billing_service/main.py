@@ -1,4 +1,5 @@
 from fastapi import FastAPI, HTTPException, Depends, Query, UploadFile, File
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer
 import httpx
 from typing import List, Optional
@@ -6,7 +7,8 @@ import os
 from datetime import datetime, date
 import json
 import logging
-from sqlalchemy import create_engine, Column, String, DateTime, Boolean, Text, Integer, Date, ForeignKey, Numeric
+import orjson
+from sqlalchemy import create_engine, exists, insert, literal, select, Column, String, DateTime, Boolean, Text, Integer, Date, ForeignKey, Numeric, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
 from sqlalchemy.dialects.postgresql import UUID
@@ -16,7 +18,7 @@ from enum import Enum
 from decimal import Decimal
 
 # Configuración
-app = FastAPI(title="Medical Records Service", version="1.0.0")
+app = FastAPI(title="Medical Records Service", version="1.0.0", default_response_class=ORJSONResponse)
 security = HTTPBearer()
 
 # Configuración de base de datos
@@ -114,7 +116,7 @@ class Consultation(Base):
     veterinarian_id = Column(UUID(as_uuid=True), nullable=False)
     
     # Información básica
-    consultation_date = Column(DateTime, default=datetime.utcnow)
+    consultation_date = Column(DateTime, default=datetime.utcnow, index=True)
     consultation_type = Column(String(50), default='general')  # general, emergency, follow_up, etc.
     chief_complaint = Column(Text)  # Motivo principal de consulta
     
@@ -182,7 +184,7 @@ class Vaccination(Base):
     expiration_date = Column(Date)
     
     # Fechas
-    vaccination_date = Column(Date, nullable=False)
+    vaccination_date = Column(Date, nullable=False, index=True)
     next_due_date = Column(Date)
     
     # Administración
@@ -342,6 +344,11 @@ class Prescription(Base):
     # Relaciones
     consultation = relationship("Consultation", back_populates="prescriptions")
 
+# Índices compuestos para listados ordenados por fecha
+Index('ix_presc_consult_created', Prescription.consultation_id, Prescription.created_at.desc())
+Index('ix_consult_record_date', Consultation.medical_record_id, Consultation.consultation_date.desc())
+Index('ix_vacc_record_date', Vaccination.medical_record_id, Vaccination.vaccination_date.desc())
+
 # Crear tablas
 Base.metadata.create_all(bind=engine)
 
@@ -533,8 +540,8 @@ class PrescriptionCreate(BaseModel):
     refills_allowed: int = 0
 
 class PrescriptionResponse(BaseModel):
-    id: str
-    consultation_id: str
+    id: uuid.UUID
+    consultation_id: uuid.UUID
     medication_name: str
     generic_name: Optional[str]
     active_ingredient: Optional[str]
@@ -866,49 +873,74 @@ async def create_prescription(
     current_user = Depends(get_current_user)
 ):
     """Crear nueva prescripción"""
-    # Verificar que existe la consulta
-    consultation = db.query(Consultation).filter(
-        Consultation.id == prescription.consultation_id
-    ).first()
+    # Crear prescripción solo si existe la consulta:
+    # INSERT ... SELECT ... WHERE EXISTS ... RETURNING en un solo viaje a la DB
+    now = datetime.utcnow()
+    values = {
+        "id": uuid.uuid4(),
+        "consultation_id": prescription.consultation_id,
+        "medication_name": prescription.medication_name,
+        "generic_name": prescription.generic_name,
+        "active_ingredient": prescription.active_ingredient,
+        "concentration": prescription.concentration,
+        "dosage": prescription.dosage,
+        "frequency": prescription.frequency,
+        "duration": prescription.duration,
+        "total_quantity": prescription.total_quantity,
+        "administration_instructions": prescription.administration_instructions,
+        "special_instructions": prescription.special_instructions,
+        "food_interactions": prescription.food_interactions,
+        "refills_allowed": prescription.refills_allowed,
+        "refills_used": 0,
+        "created_at": now,
+        "updated_at": now
+    }
+    columns = Prescription.__table__.c
+    stmt = insert(Prescription).from_select(
+        list(values),
+        select(*[literal(value, columns[name].type) for name, value in values.items()]).where(
+            exists().where(Consultation.id == prescription.consultation_id)
+        )
+    ).returning(Prescription)
+    db_prescription = db.execute(stmt).scalar_one_or_none()
     
-    if not consultation:
+    if not db_prescription:
         raise HTTPException(status_code=404, detail="Consulta no encontrada")
     
-    # Crear prescripción
-    db_prescription = Prescription(
-        consultation_id=prescription.consultation_id,
-        medication_name=prescription.medication_name,
-        generic_name=prescription.generic_name,
-        active_ingredient=prescription.active_ingredient,
-        concentration=prescription.concentration,
-        dosage=prescription.dosage,
-        frequency=prescription.frequency,
-        duration=prescription.duration,
-        total_quantity=prescription.total_quantity,
-        administration_instructions=prescription.administration_instructions,
-        special_instructions=prescription.special_instructions,
-        food_interactions=prescription.food_interactions,
-        refills_allowed=prescription.refills_allowed
-    )
-    
-    db.add(db_prescription)
+    # Serializar antes del commit para no expirar y recargar la fila
+    response = PrescriptionResponse.model_validate(db_prescription)
     db.commit()
-    db.refresh(db_prescription)
     
-    return PrescriptionResponse.from_orm(db_prescription)
+    return response
 
 @app.get("/consultations/{consultation_id}/prescriptions", response_model=List[PrescriptionResponse])
 async def get_prescriptions_by_consultation(
     consultation_id: str,
     db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)
+    current_user = Depends(get_current_user),
+    stream: bool = Query(False)
 ):
     """Obtener prescripciones de una consulta"""
+    if stream:
+        # Cursor del lado del servidor: memoria constante, una línea NDJSON por fila
+        result = db.execute(
+            select(Prescription)
+            .where(Prescription.consultation_id == consultation_id)
+            .order_by(Prescription.created_at.desc())
+            .execution_options(yield_per=500)
+        )
+        
+        def generate():
+            for prescription in result.scalars():
+                yield orjson.dumps(PrescriptionResponse.model_validate(prescription).model_dump()) + b"\n"
+        
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
+    
     prescriptions = db.query(Prescription).filter(
         Prescription.consultation_id == consultation_id
     ).order_by(Prescription.created_at.desc()).all()
     
-    return [PrescriptionResponse.from_orm(prescription) for prescription in prescriptions]
+    return [PrescriptionResponse.model_validate(prescription) for prescription in prescriptions]
 
 # ENDPOINTS DE BÚSQUEDA Y REPORTES
 
@@ -1,7 +1,72 @@
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Sum
+from django.utils import timezone
 from shared.models import BaseModel
+from datetime import date
 from decimal import Decimal
 
+
+def next_counter_value(counter_model, keys, numbered_model, number_field, number_prefix):
+    """Incrementar el contador de `keys`; al crearlo arranca tras el mayor número ya emitido con `number_prefix`"""
+    table = counter_model._meta.db_table
+    columns = ", ".join(keys)
+    with connection.cursor() as cursor:
+        # Camino habitual: la fila del periodo ya existe
+        cursor.execute(
+            f"UPDATE {table} SET value = value + 1 "
+            f"WHERE {' AND '.join(f'{column} = %s' for column in keys)} RETURNING value",
+            list(keys.values())
+        )
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+        
+        # Primer número del periodo: sembrar desde los números existentes para no repetirlos.
+        # Si otra transacción crea la fila a la vez, ON CONFLICT la incrementa igualmente.
+        cursor.execute(
+            f"INSERT INTO {table} ({columns}, value) "
+            f"SELECT {', '.join(['%s'] * len(keys))}, "
+            f"COALESCE(MAX(SUBSTRING({number_field} FROM %s)::integer), 0) + 1 "
+            f"FROM {numbered_model._meta.db_table} WHERE {number_field} LIKE %s "
+            f"ON CONFLICT ({columns}) DO UPDATE SET value = {table}.value + 1 "
+            "RETURNING value",
+            [*keys.values(), len(number_prefix) + 1, number_prefix + '%']
+        )
+        return cursor.fetchone()[0]
+
+
+class InvoiceCounter(models.Model):
+    """Contador atómico de numeración de facturas por año"""
+    year = models.IntegerField(unique=True)
+    value = models.IntegerField(default=0)
+    
+    @classmethod
+    def next_value(cls, year, number_prefix):
+        """Incrementar y devolver el contador del año"""
+        return next_counter_value(cls, {'year': year}, Invoice, 'invoice_number', number_prefix)
+    
+    class Meta:
+        db_table = 'invoice_counters'
+
+
+class PaymentCounter(models.Model):
+    """Contador atómico de numeración de pagos por año y método"""
+    year = models.IntegerField()
+    method = models.CharField(max_length=20)
+    value = models.IntegerField(default=0)
+    
+    @classmethod
+    def next_value(cls, year, method, number_prefix):
+        """Incrementar y devolver el contador del año y método"""
+        return next_counter_value(
+            cls, {'year': year, 'method': method}, Payment, 'payment_number', number_prefix
+        )
+    
+    class Meta:
+        db_table = 'payment_counters'
+        unique_together = ['year', 'method']
+
+
 class Invoice(BaseModel):
     """Facturas"""
     STATUS_CHOICES = [
@@ -54,8 +119,8 @@ class Invoice(BaseModel):
     
     def calculate_totals(self):
         """Calcular totales de la factura"""
-        # Calcular subtotal de items
-        self.subtotal = sum(item.total for item in self.items.all())
+        # Calcular subtotal de items en la base de datos (una sola agregación)
+        self.subtotal = self.items.aggregate(s=Sum('total'))['s'] or Decimal('0')
         
         # Aplicar descuento
         self.discount_amount = (self.subtotal * self.discount_percentage) / 100
@@ -72,24 +137,43 @@ class Invoice(BaseModel):
             self.status = 'paid'
         elif self.paid_amount > 0:
             self.status = 'partially_paid'
-        elif self.due_date < models.date.today() and self.status != 'paid':
+        elif self.due_date < date.today() and self.status != 'paid':
             self.status = 'overdue'
     
+    def update_totals(self):
+        """Recalcular totales y persistirlos con un único UPDATE"""
+        self.calculate_totals()
+        # update() no aplica auto_now: mantener updated_at a mano
+        self.updated_at = timezone.now()
+        Invoice.objects.filter(pk=self.pk).update(
+            subtotal=self.subtotal,
+            discount_amount=self.discount_amount,
+            tax_amount=self.tax_amount,
+            total_amount=self.total_amount,
+            status=self.status,
+            updated_at=self.updated_at,
+        )
+    
+    @classmethod
+    def create_with_items(cls, items, **invoice_fields):
+        """Crear factura con sus items en un solo INSERT multi-fila"""
+        with transaction.atomic():
+            invoice = cls.objects.create(**invoice_fields)
+            invoice_items = [InvoiceItem(invoice=invoice, **item) for item in items]
+            for item in invoice_items:
+                # bulk_create no llama a save(), calcular el total aquí
+                item.calculate_total()
+            InvoiceItem.objects.bulk_create(invoice_items, batch_size=500)
+            invoice.update_totals()
+        return invoice
+    
     def save(self, *args, **kwargs):
         if not self.invoice_number:
-            # Generar número de factura automático
+            # Generar número de factura automático (contador por año)
             current_year = self.issue_date.year
-            last_invoice = Invoice.objects.filter(
-                issue_date__year=current_year
-            ).order_by('invoice_number').last()
-            
-            if last_invoice:
-                last_number = int(last_invoice.invoice_number[-6:])
-                new_number = last_number + 1
-            else:
-                new_number = 1
-            
-            self.invoice_number = f"VET{current_year}{new_number:06d}"
+            number_prefix = f"VET{current_year}"
+            new_number = InvoiceCounter.next_value(current_year, number_prefix)
+            self.invoice_number = f"{number_prefix}{new_number:06d}"
         
         super().save(*args, **kwargs)
     
@@ -116,11 +200,14 @@ class InvoiceItem(BaseModel):
     service_date = models.DateField()
     veterinarian_id = models.UUIDField(null=True, blank=True)
     
-    def save(self, *args, **kwargs):
-        # Calcular total del item
+    def calculate_total(self):
+        """Calcular total del item"""
         subtotal = self.quantity * self.unit_price
         self.discount_amount = (subtotal * self.discount_percentage) / 100
         self.total = subtotal - self.discount_amount
+    
+    def save(self, *args, **kwargs):
+        self.calculate_total()
         super().save(*args, **kwargs)
     
     class Meta:
@@ -159,19 +246,12 @@ class Payment(BaseModel):
     
     def save(self, *args, **kwargs):
         if not self.payment_number:
-            # Generar número de pago automático
-            prefix = self.payment_method.upper()[:3]
-            last_payment = Payment.objects.filter(
-                payment_date__year=self.payment_date.year
-            ).order_by('payment_number').last()
-            
-            if last_payment:
-                last_number = int(last_payment.payment_number[-6:])
-                new_number = last_number + 1
-            else:
-                new_number = 1
-            
-            self.payment_number = f"{prefix}{self.payment_date.year}{new_number:06d}"
+            # Generar número de pago automático (contador por año y método)
+            number_prefix = f"{self.payment_method.upper()[:3]}{self.payment_date.year}"
+            new_number = PaymentCounter.next_value(
+                self.payment_date.year, self.payment_method, number_prefix
+            )
+            self.payment_number = f"{number_prefix}{new_number:06d}"
         
         super().save(*args, **kwargs)
     
@@ -1,42 +1,92 @@
 from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+import bcrypt
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import os
-import redis
-import json
+import redis.asyncio as aioredis
+import orjson
 import uuid
 import secrets
-from typing import Optional
-from sqlalchemy import create_engine, Column, String, DateTime, Boolean
+import hashlib
+import threading
+import time
+from typing import Annotated, Optional
+from cachetools import TTLCache
+from sqlalchemy import Column, String, CHAR, DateTime, Boolean, SmallInteger, case, insert, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.dialects.postgresql import UUID
-from pydantic import BaseModel, EmailStr, validator
+from sqlalchemy.dialects.postgresql import UUID, insert as pg_insert
+from pydantic import AfterValidator, BaseModel, ConfigDict, EmailStr, field_validator
 import re
 import logging
 
 # Configuración
-app = FastAPI(title="Auth Service", version="1.0.0")
+app = FastAPI(title="Auth Service", version="1.0.0", default_response_class=ORJSONResponse)
 security = HTTPBearer()
 
 # Configuración de seguridad
-SECRET_KEY = os.getenv("SECRET_KEY", secrets.token_urlsafe(32))
-ALGORITHM = "HS256"
+# PyJWT sin cryptography no soporta EdDSA; fallar al arrancar, no en el primer login
+if not jwt.algorithms.has_crypto:
+    raise RuntimeError("PyJWT requiere el backend 'cryptography' (instalar PyJWT[crypto])")
+# Tokens firmados con Ed25519: quien tenga la clave pública puede verificarlos
+# sin compartir un secreto. JWT_PRIVATE_KEY (PEM) debe ser la misma en todas las réplicas.
+_private_pem = os.getenv("JWT_PRIVATE_KEY")
+if _private_pem:
+    PRIVATE_KEY = serialization.load_pem_private_key(_private_pem.replace("\\n", "\n").encode(), password=None)
+elif os.getenv("DEBUG", "0").lower() in ("1", "true"):
+    # Solo desarrollo: cada proceso firma con su propia clave y los tokens no
+    # sobreviven a un reinicio ni se validan entre workers
+    logging.getLogger(__name__).warning(
+        "JWT_PRIVATE_KEY no definida: usando una clave Ed25519 efímera. "
+        "Los tokens dejarán de ser válidos al reiniciar y no se comparten entre procesos."
+    )
+    PRIVATE_KEY = Ed25519PrivateKey.generate()
+else:
+    raise RuntimeError("JWT_PRIVATE_KEY es obligatoria fuera de desarrollo (DEBUG=1)")
+PUBLIC_KEY = PRIVATE_KEY.public_key()
+PUBLIC_KEY_PEM = PUBLIC_KEY.public_bytes(
+    serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+).decode()
+ALGORITHM = "EdDSA"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 REFRESH_TOKEN_EXPIRE_DAYS = 7
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = 12
+# bcrypt libera el GIL: los hashes corren en paralelo fuera del event loop
+BCRYPT_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
 
 # Redis para tokens
-redis_client = redis.Redis(host='redis', port=6379, db=1, decode_responses=True)
+redis_client = aioredis.Redis(host='redis', port=6379, db=1, decode_responses=False, max_connections=64)
+INVALID_TOKEN_MARKER = b"!"
+INVALID_TOKEN_CACHE_SECONDS = 60
+
+# Caché en proceso de tokens ya verificados (evita repetir el HMAC y el viaje a Redis)
+verified_tokens = TTLCache(maxsize=10_000, ttl=5)
+verified_tokens_lock = threading.Lock()
 
 # Configuración de base de datos
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(
+    DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://"),
+    pool_size=20,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+    # PgBouncer en modo transacción no soporta sentencias preparadas con nombre fijo
+    connect_args={
+        "statement_cache_size": 0,
+        "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__"
+    }
+)
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 # Configuración de logging
@@ -59,7 +109,7 @@ class User(Base):
     is_verified = Column(Boolean, default=False)
     email_verified_at = Column(DateTime)
     last_login = Column(DateTime)
-    failed_login_attempts = Column(String(10), default='0')
+    failed_login_attempts = Column(SmallInteger, nullable=False, default=0, server_default='0')
     locked_until = Column(DateTime)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -69,7 +119,7 @@ class RefreshToken(Base):
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), nullable=False)
-    token = Column(String(255), unique=True, nullable=False)
+    token_hash = Column(CHAR(64), unique=True, nullable=False)  # sha256 del token
     expires_at = Column(DateTime, nullable=False)
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -79,55 +129,76 @@ class PasswordResetToken(Base):
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), nullable=False)
-    token = Column(String(255), unique=True, nullable=False)
+    token_hash = Column(CHAR(64), unique=True, nullable=False)  # sha256 del token
     expires_at = Column(DateTime, nullable=False)
     is_used = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
 # Crear tablas
-Base.metadata.create_all(bind=engine)
+@app.on_event("startup")
+async def create_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
 
 # Dependency para obtener sesión de DB
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+# Validaciones (regex compiladas una sola vez)
+_USERNAME = re.compile(r'^[a-zA-Z0-9_]+$')
+_PHONE = re.compile(r'^\+?[1-9]\d{9,14}$')
+
+# Clase de cada carácter como bit: 1 mayúscula, 2 minúscula, 4 dígito
+_UPPER, _LOWER, _DIGIT = 1, 2, 4
+_CHAR_CLASS = {
+    **{c: _UPPER for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'},
+    **{c: _LOWER for c in 'abcdefghijklmnopqrstuvwxyz'},
+    **{c: _DIGIT for c in '0123456789'},
+}
+
+def _check_password_strength(v: str) -> str:
+    """Reglas de contraseña compartidas por registro, reset y cambio"""
+    if len(v) < 8:
+        raise ValueError('La contraseña debe tener al menos 8 caracteres')
+    # Un solo recorrido acumulando las clases encontradas
+    mask = 0
+    for c in v:
+        mask |= _CHAR_CLASS.get(c, 0)
+    if not mask & _UPPER:
+        raise ValueError('La contraseña debe contener al menos una mayúscula')
+    if not mask & _LOWER:
+        raise ValueError('La contraseña debe contener al menos una minúscula')
+    if not mask & _DIGIT:
+        raise ValueError('La contraseña debe contener al menos un número')
+    return v
+
+# Un solo validador compartido por todos los campos de contraseña nueva
+StrongPassword = Annotated[str, AfterValidator(_check_password_strength)]
 
 # Modelos Pydantic
 class UserCreate(BaseModel):
     username: str
     email: EmailStr
-    password: str
+    password: StrongPassword
     first_name: str
     last_name: str
     phone: Optional[str] = None
     user_type: str = 'client'
     
-    @validator('username')
+    @field_validator('username')
+    @classmethod
     def validate_username(cls, v):
         if len(v) < 3:
             raise ValueError('Username debe tener al menos 3 caracteres')
-        if not re.match(r'^[a-zA-Z0-9_]+$', v):
+        if not _USERNAME.match(v):
             raise ValueError('Username solo puede contener letras, números y guiones bajos')
         return v
     
-    @validator('password')
-    def validate_password(cls, v):
-        if len(v) < 8:
-            raise ValueError('La contraseña debe tener al menos 8 caracteres')
-        if not re.search(r'[A-Z]', v):
-            raise ValueError('La contraseña debe contener al menos una mayúscula')
-        if not re.search(r'[a-z]', v):
-            raise ValueError('La contraseña debe contener al menos una minúscula')
-        if not re.search(r'\d', v):
-            raise ValueError('La contraseña debe contener al menos un número')
-        return v
-    
-    @validator('phone')
+    @field_validator('phone')
+    @classmethod
     def validate_phone(cls, v):
-        if v and not re.match(r'^\+?[1-9]\d{9,14}$', v.replace(' ', '').replace('-', '')):
+        if v and not _PHONE.match(v.replace(' ', '').replace('-', '')):
             raise ValueError('Formato de teléfono inválido')
         return v
 
@@ -136,7 +207,9 @@ class UserLogin(BaseModel):
     password: str
 
 class UserResponse(BaseModel):
-    id: str
+    model_config = ConfigDict(from_attributes=True)
+    
+    id: uuid.UUID
     username: str
     email: str
     first_name: str
@@ -146,9 +219,6 @@ class UserResponse(BaseModel):
     is_active: bool
     is_verified: bool
     created_at: datetime
-    
-    class Config:
-        from_attributes = True
 
 class Token(BaseModel):
     access_token: str
@@ -164,44 +234,42 @@ class PasswordResetRequest(BaseModel):
 
 class PasswordReset(BaseModel):
     token: str
-    new_password: str
-    
-    @validator('new_password')
-    def validate_password(cls, v):
-        if len(v) < 8:
-            raise ValueError('La contraseña debe tener al menos 8 caracteres')
-        if not re.search(r'[A-Z]', v):
-            raise ValueError('La contraseña debe contener al menos una mayúscula')
-        if not re.search(r'[a-z]', v):
-            raise ValueError('La contraseña debe contener al menos una minúscula')
-        if not re.search(r'\d', v):
-            raise ValueError('La contraseña debe contener al menos un número')
-        return v
+    new_password: StrongPassword
 
 class PasswordChange(BaseModel):
     current_password: str
-    new_password: str
-    
-    @validator('new_password')
-    def validate_password(cls, v):
-        if len(v) < 8:
-            raise ValueError('La contraseña debe tener al menos 8 caracteres')
-        if not re.search(r'[A-Z]', v):
-            raise ValueError('La contraseña debe contener al menos una mayúscula')
-        if not re.search(r'[a-z]', v):
-            raise ValueError('La contraseña debe contener al menos una minúscula')
-        if not re.search(r'\d', v):
-            raise ValueError('La contraseña debe contener al menos un número')
-        return v
+    new_password: StrongPassword
 
 # Funciones auxiliares
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verificar contraseña"""
-    return pwd_context.verify(plain_password, hashed_password)
+    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
 
 def get_password_hash(password: str) -> str:
     """Hash de contraseña"""
-    return pwd_context.hash(password)
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+async def averify_password(plain_password: str, hashed_password: str) -> bool:
+    """Verificar contraseña en el pool de bcrypt sin bloquear el event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(BCRYPT_POOL, verify_password, plain_password, hashed_password)
+
+async def ahash_password(password: str) -> str:
+    """Hash de contraseña en el pool de bcrypt sin bloquear el event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(BCRYPT_POOL, get_password_hash, password)
+
+def token_digest(token: str) -> bytes:
+    """sha256 de un token: única huella usada en la DB, en Redis y en la caché en proceso"""
+    return hashlib.sha256(token.encode()).digest()
+
+def hash_token(token: str) -> str:
+    """Hash de un token opaco para la DB (hex); nunca se guarda el token en claro"""
+    return token_digest(token).hex()
+
+def token_cache_key(token: str) -> bytes:
+    """Clave de Redis para un access token, nunca el JWT en claro"""
+    return b"tk:" + token_digest(token)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Crear JWT access token"""
@@ -212,43 +280,70 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     
     to_encode.update({"exp": expire, "type": "access"})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, PRIVATE_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def create_refresh_token(user_id: str, db: Session) -> str:
+async def create_refresh_token(user_id: str, db: AsyncSession) -> str:
     """Crear refresh token"""
     token = secrets.token_urlsafe(32)
     expires_at = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
     
-    # Desactivar tokens anteriores
-    db.query(RefreshToken).filter(
+    # Desactivar tokens anteriores y crear el nuevo en una sola sentencia
+    deactivated = update(RefreshToken).where(
         RefreshToken.user_id == user_id,
         RefreshToken.is_active == True
-    ).update({RefreshToken.is_active: False})
-    
-    # Crear nuevo token
-    db_token = RefreshToken(
-        user_id=user_id,
-        token=token,
-        expires_at=expires_at
+    ).values(is_active=False).cte("deactivated")
+    
+    await db.execute(
+        insert(RefreshToken).values(
+            user_id=user_id,
+            token_hash=hash_token(token),
+            expires_at=expires_at
+        ).add_cte(deactivated)
     )
-    db.add(db_token)
-    db.commit()
+    await db.commit()
     
     return token
 
+def get_cached_token_payload(token: str) -> Optional[dict]:
+    """Payload de un token verificado hace pocos segundos, si sigue vigente"""
+    with verified_tokens_lock:
+        payload = verified_tokens.get(token_digest(token))
+    # El TTL de la caché nunca debe superar la expiración del propio token
+    if payload and payload["exp"] > time.time():
+        return payload
+    return None
+
+def forget_token(token: str):
+    """Sacar un token de la caché en proceso"""
+    with verified_tokens_lock:
+        verified_tokens.pop(token_digest(token), None)
+
 def verify_token(token: str) -> Optional[dict]:
     """Verificar JWT token"""
+    cached_payload = get_cached_token_payload(token)
+    if cached_payload:
+        return cached_payload
+    
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, PUBLIC_KEY, algorithms=[ALGORITHM])
         user_id: str = payload.get("sub")
         token_type: str = payload.get("type")
         
         if user_id is None or token_type != "access":
             return None
         
-        return {"user_id": user_id, "exp": payload.get("exp")}
-    except JWTError:
+        verified = {
+            "user_id": user_id,
+            "exp": payload.get("exp"),
+            "username": payload.get("username"),
+            "email": payload.get("email"),
+            "user_type": payload.get("user_type")
+        }
+        with verified_tokens_lock:
+            verified_tokens[token_digest(token)] = verified
+        return verified
+    except jwt.InvalidTokenError:
         return None
 
 def is_account_locked(user: User) -> bool:
@@ -257,76 +352,85 @@ def is_account_locked(user: User) -> bool:
         return True
     return False
 
-def increment_failed_attempts(user: User, db: Session):
-    """Incrementar intentos fallidos de login"""
-    try:
-        current_attempts = int(user.failed_login_attempts or '0')
-    except:
-        current_attempts = 0
-    
-    current_attempts += 1
-    user.failed_login_attempts = str(current_attempts)
-    
-    # Bloquear cuenta después de 5 intentos fallidos
-    if current_attempts >= 5:
-        user.locked_until = datetime.utcnow() + timedelta(minutes=30)
-    
-    db.commit()
-
-def reset_failed_attempts(user: User, db: Session):
-    """Resetear intentos fallidos de login"""
-    user.failed_login_attempts = '0'
-    user.locked_until = None
-    user.last_login = datetime.utcnow()
-    db.commit()
+async def increment_failed_attempts(user_id, db: AsyncSession):
+    """Incrementar intentos fallidos de login (atómico en la DB)"""
+    attempts = User.failed_login_attempts + 1
+    await db.execute(
+        update(User).where(User.id == user_id).values(
+            failed_login_attempts=attempts,
+            # Bloquear cuenta después de 5 intentos fallidos
+            locked_until=case(
+                (attempts >= 5, datetime.utcnow() + timedelta(minutes=30)),
+                else_=User.locked_until
+            )
+        )
+    )
+    await db.commit()
+
+async def reset_failed_attempts(user_id, db: AsyncSession):
+    """Resetear intentos fallidos de login (se confirma con el siguiente commit)"""
+    await db.execute(
+        update(User).where(User.id == user_id).values(
+            failed_login_attempts=0,
+            locked_until=None,
+            last_login=datetime.utcnow()
+        )
+    )
 
 # Endpoints
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "service": "auth"}
 
+@app.get("/public-key")
+async def get_public_key():
+    """Clave pública para verificar access tokens sin llamar a /verify-token"""
+    return {"algorithm": ALGORITHM, "public_key": PUBLIC_KEY_PEM}
+
 @app.post("/register", response_model=UserResponse)
-async def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     """Registrar nuevo usuario"""
-    # Verificar si el usuario ya existe
-    existing_user = db.query(User).filter(
-        (User.username == user.username) | (User.email == user.email)
-    ).first()
-    
-    if existing_user:
+    hashed_password = await ahash_password(user.password)
+    
+    # Insertar solo si username y email están libres (sin SELECT previo ni carrera)
+    db_user = (await db.execute(
+        pg_insert(User).values(
+            username=user.username,
+            email=user.email,
+            password_hash=hashed_password,
+            first_name=user.first_name,
+            last_name=user.last_name,
+            phone=user.phone,
+            user_type=user.user_type
+        ).on_conflict_do_nothing().returning(User)
+    )).scalar_one_or_none()
+    
+    if db_user is None:
         raise HTTPException(
             status_code=400,
             detail="Username o email ya existe"
         )
     
-    # Crear nuevo usuario
-    hashed_password = get_password_hash(user.password)
-    db_user = User(
-        username=user.username,
-        email=user.email,
-        password_hash=hashed_password,
-        first_name=user.first_name,
-        last_name=user.last_name,
-        phone=user.phone,
-        user_type=user.user_type
-    )
-    
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
     
     # TODO: Enviar email de verificación
     
-    return UserResponse.from_orm(db_user)
+    return UserResponse.model_validate(db_user)
 
 @app.post("/login", response_model=Token)
-async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
+async def login(user_credentials: UserLogin, db: AsyncSession = Depends(get_db)):
     """Iniciar sesión"""
-    # Buscar usuario
-    user = db.query(User).filter(
-        (User.username == user_credentials.username) | 
-        (User.email == user_credentials.username)
-    ).first()
+    # Buscar usuario (solo las columnas que necesita el login)
+    user = (await db.execute(
+        select(
+            User.id, User.username, User.email, User.user_type,
+            User.password_hash, User.is_active, User.locked_until,
+            User.failed_login_attempts
+        ).where(
+            or_(User.username == user_credentials.username,
+                User.email == user_credentials.username)
+        )
+    )).first()
     
     if not user:
         raise HTTPException(
@@ -349,36 +453,43 @@ async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
         )
     
     # Verificar contraseña
-    if not verify_password(user_credentials.password, user.password_hash):
-        increment_failed_attempts(user, db)
+    if not await averify_password(user_credentials.password, user.password_hash):
+        await increment_failed_attempts(user.id, db)
         raise HTTPException(
             status_code=401,
             detail="Credenciales incorrectas"
         )
     
-    # Login exitoso
-    reset_failed_attempts(user, db)
+    # Login exitoso (se guarda junto con el refresh token, un solo commit)
+    await reset_failed_attempts(user.id, db)
     
     # Crear tokens
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": str(user.id), "username": user.username, "user_type": user.user_type},
-        expires_delta=access_token_expires
-    )
-    refresh_token = create_refresh_token(str(user.id), db)
-    
-    # Cachear token en Redis
-    redis_client.setex(
-        f"token:{access_token}",
-        ACCESS_TOKEN_EXPIRE_MINUTES * 60,
-        json.dumps({
-            "id": str(user.id),
+        data={
+            "sub": str(user.id),
             "username": user.username,
             "email": user.email,
-            "user_type": user.user_type,
-            "token": access_token
-        })
+            "user_type": user.user_type
+        },
+        expires_delta=access_token_expires
     )
+    refresh_token = await create_refresh_token(str(user.id), db)
+    
+    # Cachear token y contar el login en un solo viaje a Redis
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.setex(
+            token_cache_key(access_token),
+            ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+            orjson.dumps({
+                "id": str(user.id),
+                "username": user.username,
+                "email": user.email,
+                "user_type": user.user_type
+            })
+        )
+        pipe.incr(f"user_logins:{user.id}")
+        await pipe.execute()
     
     return Token(
         access_token=access_token,
@@ -387,14 +498,16 @@ async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
     )
 
 @app.post("/refresh", response_model=Token)
-async def refresh_token_endpoint(token_data: TokenRefresh, db: Session = Depends(get_db)):
+async def refresh_token_endpoint(token_data: TokenRefresh, db: AsyncSession = Depends(get_db)):
     """Renovar access token usando refresh token"""
     # Verificar refresh token
-    refresh_token = db.query(RefreshToken).filter(
-        RefreshToken.token == token_data.refresh_token,
-        RefreshToken.is_active == True,
-        RefreshToken.expires_at > datetime.utcnow()
-    ).first()
+    refresh_token = (await db.execute(
+        select(RefreshToken).where(
+            RefreshToken.token_hash == hash_token(token_data.refresh_token),
+            RefreshToken.is_active == True,
+            RefreshToken.expires_at > datetime.utcnow()
+        )
+    )).scalar_one_or_none()
     
     if not refresh_token:
         raise HTTPException(
@@ -403,7 +516,7 @@ async def refresh_token_endpoint(token_data: TokenRefresh, db: Session = Depends
         )
     
     # Obtener usuario
-    user = db.query(User).filter(User.id == refresh_token.user_id).first()
+    user = await db.get(User, refresh_token.user_id)
     if not user or not user.is_active:
         raise HTTPException(
             status_code=401,
@@ -413,23 +526,16 @@ async def refresh_token_endpoint(token_data: TokenRefresh, db: Session = Depends
     # Crear nuevo access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": str(user.id), "username": user.username, "user_type": user.user_type},
-        expires_delta=access_token_expires
-    )
-    
-    # Cachear token en Redis
-    redis_client.setex(
-        f"token:{access_token}",
-        ACCESS_TOKEN_EXPIRE_MINUTES * 60,
-        json.dumps({
-            "id": str(user.id),
+        data={
+            "sub": str(user.id),
             "username": user.username,
             "email": user.email,
-            "user_type": user.user_type,
-            "token": access_token
-        })
+            "user_type": user.user_type
+        },
+        expires_delta=access_token_expires
     )
     
+    # No se cachea aquí: /verify-token llena Redis en el primer uso del token
     return Token(
         access_token=access_token,
         refresh_token=token_data.refresh_token,
@@ -437,18 +543,37 @@ async def refresh_token_endpoint(token_data: TokenRefresh, db: Session = Depends
     )
 
 @app.get("/verify-token")
-async def verify_token_endpoint(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def verify_token_endpoint(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_db)):
     """Verificar validez del token"""
     token = credentials.credentials
     
-    # Verificar en Redis primero
-    cached_user = redis_client.get(f"token:{token}")
+    # Token verificado hace segundos en este proceso: responder sin Redis ni HMAC
+    payload = get_cached_token_payload(token)
+    if payload and payload["username"] and payload["email"] and payload["user_type"]:
+        return {
+            "id": payload["user_id"],
+            "username": payload["username"],
+            "email": payload["email"],
+            "user_type": payload["user_type"],
+            "token": token
+        }
+    
+    cache_key = token_cache_key(token)
+    
+    # Verificar en Redis primero (incluye tokens inválidos recientes)
+    cached_user = await redis_client.get(cache_key)
+    if cached_user == INVALID_TOKEN_MARKER:
+        raise HTTPException(
+            status_code=401,
+            detail="Token inválido"
+        )
     if cached_user:
-        return json.loads(cached_user)
+        return {**orjson.loads(cached_user), "token": token}
     
     # Verificar token JWT
     payload = verify_token(token)
     if not payload:
+        await redis_client.setex(cache_key, INVALID_TOKEN_CACHE_SECONDS, INVALID_TOKEN_MARKER)
         raise HTTPException(
             status_code=401,
             detail="Token inválido"
@@ -456,9 +581,17 @@ async def verify_token_endpoint(credentials: HTTPAuthorizationCredentials = Depe
     
     # Token válido pero no en caché, regenerar caché
     # Esto podría pasar si Redis se reinició
-    user_id = payload["user_id"]
-    with SessionLocal() as db:
-        user = db.query(User).filter(User.id == user_id).first()
+    if payload["username"] and payload["email"] and payload["user_type"]:
+        # Los claims del JWT bastan, sin consultar la DB
+        user_data = {
+            "id": payload["user_id"],
+            "username": payload["username"],
+            "email": payload["email"],
+            "user_type": payload["user_type"]
+        }
+    else:
+        # Tokens emitidos antes de incluir todos los claims
+        user = await db.get(User, uuid.UUID(payload["user_id"]))
         if not user or not user.is_active:
             raise HTTPException(
                 status_code=401,
@@ -469,52 +602,63 @@ async def verify_token_endpoint(credentials: HTTPAuthorizationCredentials = Depe
             "id": str(user.id),
             "username": user.username,
             "email": user.email,
-            "user_type": user.user_type,
-            "token": token
+            "user_type": user.user_type
         }
-        
-        # Cachear por tiempo restante del token
-        exp_timestamp = payload["exp"]
-        remaining_time = exp_timestamp - datetime.utcnow().timestamp()
-        if remaining_time > 0:
-            redis_client.setex(f"token:{token}", int(remaining_time), json.dumps(user_data))
-        
-        return user_data
+    
+    # Cachear por tiempo restante del token
+    exp_timestamp = payload["exp"]
+    remaining_time = exp_timestamp - datetime.utcnow().timestamp()
+    if remaining_time > 0:
+        await redis_client.setex(cache_key, int(remaining_time), orjson.dumps(user_data))
+    
+    return {**user_data, "token": token}
 
 @app.post("/logout")
-async def logout(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+async def logout(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_db)):
     """Cerrar sesión"""
     token = credentials.credentials
     
+    # Decodificar una sola vez; el mismo payload sirve para Redis y la DB
+    payload = verify_token(token)
+    forget_token(token)
+    
     # Remover token de Redis
-    redis_client.delete(f"token:{token}")
+    redis_delete = redis_client.delete(token_cache_key(token))
     
-    # Invalidar refresh tokens asociados
-    payload = verify_token(token)
     if payload:
+        # Invalidar refresh tokens asociados en paralelo con Redis
         user_id = payload["user_id"]
-        db.query(RefreshToken).filter(
-            RefreshToken.user_id == user_id,
-            RefreshToken.is_active == True
-        ).update({RefreshToken.is_active: False})
-        db.commit()
+        await asyncio.gather(
+            redis_delete,
+            db.execute(
+                update(RefreshToken).where(
+                    RefreshToken.user_id == user_id,
+                    RefreshToken.is_active == True
+                ).values(is_active=False)
+            )
+        )
+        await db.commit()
+    else:
+        await redis_delete
     
     return {"message": "Logout exitoso"}
 
 @app.post("/forgot-password")
-async def forgot_password(request: PasswordResetRequest, db: Session = Depends(get_db)):
+async def forgot_password(request: PasswordResetRequest, db: AsyncSession = Depends(get_db)):
     """Solicitar reset de contraseña"""
-    user = db.query(User).filter(User.email == request.email).first()
+    user = (await db.execute(select(User).where(User.email == request.email))).scalar_one_or_none()
     
     if not user:
         # No revelar si el email existe o no por seguridad
         return {"message": "Si el email existe, se enviará un enlace de recuperación"}
     
     # Invalidar tokens anteriores
-    db.query(PasswordResetToken).filter(
-        PasswordResetToken.user_id == user.id,
-        PasswordResetToken.is_used == False
-    ).update({PasswordResetToken.is_used: True})
+    await db.execute(
+        update(PasswordResetToken).where(
+            PasswordResetToken.user_id == user.id,
+            PasswordResetToken.is_used == False
+        ).values(is_used=True)
+    )
     
     # Crear nuevo token
     reset_token = secrets.token_urlsafe(32)
@@ -522,25 +666,27 @@ async def forgot_password(request: PasswordResetRequest, db: Session = Depends(g
     
     db_token = PasswordResetToken(
         user_id=user.id,
-        token=reset_token,
+        token_hash=hash_token(reset_token),
         expires_at=expires_at
     )
     db.add(db_token)
-    db.commit()
+    await db.commit()
     
     # TODO: Enviar email con enlace de reset
     
     return {"message": "Si el email existe, se enviará un enlace de recuperación"}
 
 @app.post("/reset-password")
-async def reset_password(request: PasswordReset, db: Session = Depends(get_db)):
+async def reset_password(request: PasswordReset, db: AsyncSession = Depends(get_db)):
     """Resetear contraseña con token"""
     # Verificar token
-    reset_token = db.query(PasswordResetToken).filter(
-        PasswordResetToken.token == request.token,
-        PasswordResetToken.is_used == False,
-        PasswordResetToken.expires_at > datetime.utcnow()
-    ).first()
+    reset_token = (await db.execute(
+        select(PasswordResetToken).where(
+            PasswordResetToken.token_hash == hash_token(request.token),
+            PasswordResetToken.is_used == False,
+            PasswordResetToken.expires_at > datetime.utcnow()
+        )
+    )).scalar_one_or_none()
     
     if not reset_token:
         raise HTTPException(
@@ -549,7 +695,7 @@ async def reset_password(request: PasswordReset, db: Session = Depends(get_db)):
         )
     
     # Obtener usuario
-    user = db.query(User).filter(User.id == reset_token.user_id).first()
+    user = await db.get(User, reset_token.user_id)
     if not user:
         raise HTTPException(
             status_code=404,
@@ -557,15 +703,15 @@ async def reset_password(request: PasswordReset, db: Session = Depends(get_db)):
         )
     
     # Actualizar contraseña
-    user.password_hash = get_password_hash(request.new_password)
+    user.password_hash = await ahash_password(request.new_password)
     reset_token.is_used = True
     
     # Invalidar todos los refresh tokens
-    db.query(RefreshToken).filter(
-        RefreshToken.user_id == user.id
-    ).update({RefreshToken.is_active: False})
+    await db.execute(
+        update(RefreshToken).where(RefreshToken.user_id == user.id).values(is_active=False)
+    )
     
-    db.commit()
+    await db.commit()
     
     return {"message": "Contraseña actualizada exitosamente"}
 
@@ -573,7 +719,7 @@ async def reset_password(request: PasswordReset, db: Session = Depends(get_db)):
 async def change_password(
     request: PasswordChange,
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Cambiar contraseña (usuario autenticado)"""
     # Verificar token
@@ -582,27 +728,27 @@ async def change_password(
         raise HTTPException(status_code=401, detail="Token inválido")
     
     # Obtener usuario
-    user = db.query(User).filter(User.id == payload["user_id"]).first()
+    user = await db.get(User, uuid.UUID(payload["user_id"]))
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     
     # Verificar contraseña actual
-    if not verify_password(request.current_password, user.password_hash):
+    if not await averify_password(request.current_password, user.password_hash):
         raise HTTPException(
             status_code=400,
             detail="Contraseña actual incorrecta"
         )
     
     # Actualizar contraseña
-    user.password_hash = get_password_hash(request.new_password)
-    db.commit()
+    user.password_hash = await ahash_password(request.new_password)
+    await db.commit()
     
     return {"message": "Contraseña cambiada exitosamente"}
 
 @app.get("/profile", response_model=UserResponse)
 async def get_profile(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Obtener perfil del usuario autenticado"""
     # Verificar token
@@ -611,11 +757,11 @@ async def get_profile(
         raise HTTPException(status_code=401, detail="Token inválido")
     
     # Obtener usuario
-    user = db.query(User).filter(User.id == payload["user_id"]).first()
+    user = await db.get(User, uuid.UUID(payload["user_id"]))
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     
-    return UserResponse.from_orm(user)
+    return UserResponse.model_validate(user)
 
 if __name__ == "__main__":
     import uvicorn
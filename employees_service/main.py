@@ -1,30 +1,48 @@
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer
 import httpx
-from typing import List, Optional
+import orjson
+import redis.asyncio as aioredis
+import hashlib
+from cachetools import TTLCache
+from typing import List, Literal, Optional, Tuple
 import os
-from datetime import datetime, date, time
-import json
+from datetime import datetime, date, time, timedelta
 import logging
-from sqlalchemy import create_engine, Column, String, DateTime, Boolean, Text, Integer, Date, Time, ForeignKey
+from sqlalchemy import Column, String, DateTime, Boolean, Text, Integer, Date, Time, ForeignKey, Index, Computed, cast, func, literal, or_, select, text, true, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import aliased, relationship
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR, UUID, insert as pg_insert
 import uuid
-from pydantic import BaseModel, EmailStr, validator
+from pydantic import BaseModel, ConfigDict, EmailStr, ValidationInfo, field_validator
 from enum import Enum
 from decimal import Decimal
 
 # Configuración
-app = FastAPI(title="Employees Service", version="1.0.0")
+app = FastAPI(title="Employees Service", version="1.0.0", default_response_class=ORJSONResponse)
 security = HTTPBearer()
 
 # Configuración de base de datos
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Pool configurable por entorno: DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE
+engine = create_async_engine(
+    DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://"),
+    pool_size=int(os.getenv("DB_POOL_SIZE", 20)),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 40)),
+    pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", 10)),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 1800)),
+    pool_pre_ping=True
+)
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
+# Redis para caché de disponibilidad
+redis_client = aioredis.from_url(os.getenv("REDIS_URL", "redis://redis:6379/7"))
+AVAILABILITY_CACHE_TTL = 24 * 60 * 60
+
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -53,12 +71,12 @@ class Employee(Base):
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), unique=True, nullable=False)  # Referencia al usuario
-    employee_code = Column(String(20), unique=True, nullable=False)
+    employee_code = Column(String(20), unique=True, nullable=False, server_default=text("next_employee_code()"))
     full_name = Column(String(200), nullable=False)
     document_number = Column(String(20), unique=True, nullable=False)
     phone = Column(String(15), nullable=False)
-    email = Column(String(255), nullable=False)
-    roles = Column(Text, nullable=False)  # JSON string con lista de roles
+    email = Column(String(255), unique=True, nullable=False)
+    roles = Column(JSONB, nullable=False)  # Lista de roles
     specialization = Column(String(200))  # Para veterinarios
     license_number = Column(String(50))  # Tarjeta profesional
     hire_date = Column(Date, nullable=False)
@@ -74,9 +92,29 @@ class Employee(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     is_active = Column(Boolean, default=True)
     
-    # Relaciones
-    schedules = relationship("WorkSchedule", back_populates="employee")
-    availability = relationship("EmployeeAvailability", back_populates="employee")
+    # Búsqueda de texto completo, mantenida por Postgres
+    search_vector = Column(TSVECTOR, Computed(
+        "to_tsvector('simple', coalesce(full_name, '') || ' ' || coalesce(employee_code, '') || ' ' || "
+        "coalesce(document_number, '') || ' ' || coalesce(email, ''))",
+        persisted=True
+    ))
+    
+    # Relaciones: nunca se cargan en diferido (sería una consulta por fila).
+    # Quien las necesite debe pedirlas explícitamente, p. ej.
+    # select(Employee).options(selectinload(Employee.schedules), selectinload(Employee.availability))
+    schedules = relationship("WorkSchedule", back_populates="employee", lazy="raise")
+    availability = relationship("EmployeeAvailability", back_populates="employee", lazy="raise")
+    
+    __table_args__ = (
+        # Filtros por rol con @> (containment) usando el índice
+        Index('ix_employees_roles_gin', 'roles', postgresql_using='gin', postgresql_ops={'roles': 'jsonb_path_ops'}),
+        # Listado paginado: WHERE is_active ORDER BY created_at DESC
+        Index('ix_emp_active_created', 'is_active', 'created_at'),
+        # ILIKE '%...%' solo puede usar índices trigram (requiere pg_trgm)
+        Index('ix_emp_department_trgm', 'department', postgresql_using='gin', postgresql_ops={'department': 'gin_trgm_ops'}),
+        Index('ix_emp_fullname_trgm', 'full_name', postgresql_using='gin', postgresql_ops={'full_name': 'gin_trgm_ops'}),
+        Index('ix_emp_fts', 'search_vector', postgresql_using='gin'),
+    )
 
 class WorkSchedule(Base):
     __tablename__ = "work_schedules"
@@ -93,7 +131,13 @@ class WorkSchedule(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relaciones
-    employee = relationship("Employee", back_populates="schedules")
+    employee = relationship("Employee", back_populates="schedules", lazy="raise")
+    
+    __table_args__ = (
+        Index('ix_ws_emp_day_active', 'employee_id', 'day_of_week', 'is_active'),
+        # Un solo horario activo por empleado y día
+        Index('uq_ws_emp_day_active', 'employee_id', 'day_of_week', unique=True, postgresql_where=text('is_active')),
+    )
 
 class EmployeeAvailability(Base):
     __tablename__ = "employee_availability"
@@ -109,7 +153,11 @@ class EmployeeAvailability(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relaciones
-    employee = relationship("Employee", back_populates="availability")
+    employee = relationship("Employee", back_populates="availability", lazy="raise")
+    
+    __table_args__ = (
+        Index('ix_av_emp_date', 'employee_id', 'date'),
+    )
 
 class Department(Base):
     __tablename__ = "departments"
@@ -122,16 +170,36 @@ class Department(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     is_active = Column(Boolean, default=True)
 
-# Crear tablas
-Base.metadata.create_all(bind=engine)
+# Crear tablas (los índices trigram necesitan la extensión pg_trgm y
+# employee_code se numera en la DB con una secuencia que no se reinicia por año)
+@app.on_event("startup")
+async def create_tables():
+    async with engine.begin() as conn:
+        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        await conn.execute(text("CREATE SEQUENCE IF NOT EXISTS emp_code_seq"))
+        await conn.execute(text("""
+            CREATE OR REPLACE FUNCTION next_employee_code() RETURNS varchar
+            LANGUAGE sql AS $$
+                SELECT 'EMP' || to_char(now(), 'YYYY') || lpad(n::text, greatest(4, length(n::text)), '0')
+                FROM nextval('emp_code_seq') AS n
+            $$
+        """))
+        await conn.run_sync(Base.metadata.create_all)
+        # Continuar tras el mayor código ya emitido este año (DB existente o restaurada);
+        # nunca retrocede respecto al valor actual de la secuencia
+        await conn.execute(text("""
+            SELECT setval('emp_code_seq', GREATEST(
+                COALESCE(MAX(substring(employee_code FROM 8)::int), 0),
+                (SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM emp_code_seq)
+            ) + 1, false)
+            FROM employees
+            WHERE employee_code ~ ('^EMP' || to_char(now(), 'YYYY') || '[0-9]+$')
+        """))
 
 # Dependency para obtener sesión de DB
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # Modelos Pydantic
 class EmployeeCreate(BaseModel):
@@ -149,13 +217,15 @@ class EmployeeCreate(BaseModel):
     emergency_contact_name: Optional[str] = None
     emergency_contact_phone: Optional[str] = None
     
-    @validator('roles')
+    @field_validator('roles')
+    @classmethod
     def validate_roles(cls, v):
         if not v:
             raise ValueError('Debe asignar al menos un rol')
         return v
     
-    @validator('document_number')
+    @field_validator('document_number')
+    @classmethod
     def validate_document_number(cls, v):
         if not v or len(v) < 7:
             raise ValueError('Número de documento inválido')
@@ -172,9 +242,19 @@ class EmployeeUpdate(BaseModel):
     position: Optional[str] = None
     emergency_contact_name: Optional[str] = None
     emergency_contact_phone: Optional[str] = None
+    
+    @field_validator('roles')
+    @classmethod
+    def validate_roles(cls, v):
+        # Omitir el campo deja los roles como están; null o [] no son válidos
+        if not v:
+            raise ValueError('Debe asignar al menos un rol')
+        return v
 
 class EmployeeResponse(BaseModel):
-    id: str
+    model_config = ConfigDict(from_attributes=True)
+    
+    id: uuid.UUID
     employee_code: str
     full_name: str
     document_number: str
@@ -188,36 +268,47 @@ class EmployeeResponse(BaseModel):
     position: Optional[str]
     created_at: datetime
     is_active: bool
-    
-    class Config:
-        from_attributes = True
 
-class WorkScheduleCreate(BaseModel):
-    employee_id: str
+class AvailabilityBatchRequest(BaseModel):
+    employee_ids: List[uuid.UUID]
+    date_from: date
+    date_to: date
+    
+    @field_validator('employee_ids')
+    @classmethod
+    def validate_employee_ids(cls, v):
+        if not v or len(v) > 100:
+            raise ValueError('Debe indicar entre 1 y 100 empleados')
+        return v
+
+class WorkScheduleDay(BaseModel):
     day_of_week: DayOfWeek
     start_time: time
     end_time: time
     break_start: Optional[time] = None
     break_end: Optional[time] = None
     
-    @validator('end_time')
-    def validate_times(cls, v, values):
-        if 'start_time' in values and v <= values['start_time']:
+    @field_validator('end_time')
+    @classmethod
+    def validate_times(cls, v, info: ValidationInfo):
+        if 'start_time' in info.data and v <= info.data['start_time']:
             raise ValueError('Hora de fin debe ser posterior a hora de inicio')
         return v
 
-class WorkScheduleResponse(BaseModel):
-    id: str
+class WorkScheduleCreate(WorkScheduleDay):
     employee_id: str
+
+class WorkScheduleResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    
+    id: uuid.UUID
+    employee_id: uuid.UUID
     day_of_week: int
     start_time: time
     end_time: time
     break_start: Optional[time]
     break_end: Optional[time]
     is_active: bool
-    
-    class Config:
-        from_attributes = True
 
 class AvailabilityCreate(BaseModel):
     employee_id: str
@@ -228,62 +319,230 @@ class AvailabilityCreate(BaseModel):
     reason: Optional[str] = None
 
 class AvailabilityResponse(BaseModel):
-    id: str
-    employee_id: str
+    model_config = ConfigDict(from_attributes=True)
+    
+    id: uuid.UUID
+    employee_id: uuid.UUID
     date: date
     start_time: time
     end_time: time
     is_available: bool
     reason: Optional[str]
-    
-    class Config:
-        from_attributes = True
+
+# Columnas de Employee que componen EmployeeResponse (consultas sin objetos ORM)
+EMPLOYEE_RESPONSE_COLUMNS = [getattr(Employee, field) for field in EmployeeResponse.model_fields]
+
+# Columnas de EmployeeAvailability que componen AvailabilityResponse
+AVAILABILITY_RESPONSE_COLUMNS = [getattr(EmployeeAvailability, field) for field in AvailabilityResponse.model_fields]
 
 # Verificación de autenticación
+# Cliente HTTP compartido con el servicio de auth (reutiliza conexiones)
+AUTH_CLIENT: Optional[httpx.AsyncClient] = None
+# Tokens verificados recientemente, por hash del token
+verified_tokens = TTLCache(maxsize=10_000, ttl=30)
+
+@app.on_event("startup")
+async def start_auth_client():
+    global AUTH_CLIENT
+    AUTH_CLIENT = httpx.AsyncClient(
+        base_url=os.getenv('AUTH_SERVICE_URL'),
+        timeout=5.0,
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
+    )
+
+@app.on_event("shutdown")
+async def close_auth_client():
+    await AUTH_CLIENT.aclose()
+
 async def verify_token(token: str):
     """Verificar token con el servicio de autenticación"""
+    cache_key = hashlib.sha256(token.encode()).digest()
+    user = verified_tokens.get(cache_key)
+    if user:
+        return user
+    
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{os.getenv('AUTH_SERVICE_URL')}/verify-token",
-                headers={"Authorization": f"Bearer {token}"}
-            )
-            if response.status_code == 200:
-                return response.json()
+        response = await AUTH_CLIENT.get(
+            "/verify-token",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        if response.status_code == 200:
+            user = orjson.loads(response.content)
+            verified_tokens[cache_key] = user
+            return user
     except Exception as e:
         logger.error(f"Error verificando token: {e}")
     return None
 
-async def get_current_user(token: str = Depends(security)):
+async def get_current_user(request: Request, token: str = Depends(security)):
+    # Ya verificado en esta misma petición
+    user = getattr(request.state, "user", None)
+    if user:
+        return user
+    
     user = await verify_token(token.credentials)
     if not user:
         raise HTTPException(status_code=401, detail="Token inválido")
+    request.state.user = user
     return user
 
-def check_admin_permission(user: dict):
-    """Verificar que el usuario tiene permisos de administrador"""
+async def require_admin(user: dict = Depends(get_current_user)):
+    """Usuario autenticado con permisos de administrador"""
     if user.get("user_type") not in ["admin", "manager"]:
         raise HTTPException(
             status_code=403,
             detail="No tiene permisos para realizar esta acción"
         )
+    return user
 
 # Funciones auxiliares
-def generate_employee_code(db: Session) -> str:
-    """Generar código único de empleado"""
-    year = datetime.now().year
-    # Buscar último empleado del año
-    last_employee = db.query(Employee).filter(
-        Employee.employee_code.like(f"EMP{year}%")
-    ).order_by(Employee.employee_code.desc()).first()
-    
-    if last_employee:
-        last_number = int(last_employee.employee_code[-4:])
-        new_number = last_number + 1
+MAX_AVAILABILITY_RANGE_DAYS = 92
+
+def build_day_availability(day: date, regular_schedule, specific_availability) -> dict:
+    """Disponibilidad de un día: la específica manda sobre el horario regular"""
+    if specific_availability:
+        # Si hay disponibilidad específica, usar esa
+        return {
+            "date": day,
+            "is_available": specific_availability.is_available,
+            "start_time": specific_availability.start_time if specific_availability.is_available else None,
+            "end_time": specific_availability.end_time if specific_availability.is_available else None,
+            "reason": specific_availability.reason
+        }
+    elif regular_schedule:
+        # Si no hay disponibilidad específica, usar horario regular
+        return {
+            "date": day,
+            "is_available": True,
+            "start_time": regular_schedule.start_time,
+            "end_time": regular_schedule.end_time,
+            "break_start": regular_schedule.break_start,
+            "break_end": regular_schedule.break_end
+        }
     else:
-        new_number = 1
+        # No hay horario para ese día
+        return {
+            "date": day,
+            "is_available": False,
+            "reason": "No hay horario asignado para este día"
+        }
+
+async def fetch_schedules_and_availability(db: AsyncSession, employee_ids: list, date_from: date, date_to: date):
+    """Horarios regulares y disponibilidad específica de varios empleados en un rango.
+    
+    Dos consultas en total, sin importar cuántos empleados o días. Devuelve
+    ({(employee_id, day_of_week): horario}, {(employee_id, fecha): disponibilidad}).
+    """
+    schedules = (await db.execute(select(WorkSchedule).where(
+        WorkSchedule.employee_id.in_(employee_ids),
+        WorkSchedule.is_active == True
+    ))).scalars().all()
+    
+    availability = (await db.execute(select(EmployeeAvailability).where(
+        EmployeeAvailability.employee_id.in_(employee_ids),
+        EmployeeAvailability.date.between(date_from, date_to)
+    ))).scalars().all()
+    
+    return (
+        {(str(ws.employee_id), ws.day_of_week): ws for ws in schedules},
+        {(str(av.employee_id), av.date): av for av in availability}
+    )
+
+# Restricciones únicas -> mensaje de error para el cliente
+UNIQUE_VIOLATIONS = {
+    "employees_document_number_key": "Ya existe un empleado con ese número de documento",
+    "employees_email_key": "Ya existe un empleado con ese email",
+    "employees_user_id_key": "Ya existe un empleado para ese usuario",
+    "employees_employee_code_key": "El código de empleado generado ya existe, intente de nuevo",
+    "uq_ws_emp_day_active": "Ya existe un horario para ese día. Use actualizar para modificarlo.",
+}
+
+async def commit_or_conflict(db: AsyncSession):
+    """Confirmar cambios; las violaciones de unicidad se devuelven como 400"""
+    try:
+        await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        error = str(e.orig)
+        for constraint, message in UNIQUE_VIOLATIONS.items():
+            if constraint in error:
+                raise HTTPException(status_code=400, detail=message)
+        raise
+
+# Caché de disponibilidad por día: hash avail:{employee_id} con un campo por fecha.
+# Se invalida completo con cada cambio de horario o disponibilidad del empleado.
+def availability_cache_key(employee_id) -> str:
+    return f"avail:{employee_id}"
+
+def availability_generation_key(employee_id) -> str:
+    return f"avail:gen:{employee_id}"
+
+# Guardar el día solo si no hubo escrituras desde que se leyó la generación;
+# el TTL se fija al crear el hash y no se renueva con cada llenado
+FILL_AVAILABILITY_SCRIPT = redis_client.register_script("""
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[3] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+if redis.call('TTL', KEYS[1]) < 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+end
+return 1
+""")
+
+async def get_cached_day_availability(employee_id, day: date) -> Tuple[Optional[dict], Optional[bytes]]:
+    """Día cacheado (o None) y la generación vigente, a pasar luego a cache_day_availability"""
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hget(availability_cache_key(employee_id), day.isoformat())
+            pipe.get(availability_generation_key(employee_id))
+            cached, generation = await pipe.execute()
+        return (orjson.loads(cached) if cached else None), generation or b""
+    except Exception as e:
+        logger.error(f"Error leyendo caché de disponibilidad: {e}")
+    # Sin generación conocida no se llena la caché
+    return None, None
+
+async def cache_day_availability(employee_id, day: date, data: dict, generation: Optional[bytes]):
+    if generation is None:
+        return
+    try:
+        await FILL_AVAILABILITY_SCRIPT(
+            keys=[availability_cache_key(employee_id), availability_generation_key(employee_id)],
+            args=[day.isoformat(), orjson.dumps(data), generation, AVAILABILITY_CACHE_TTL]
+        )
+    except Exception as e:
+        logger.error(f"Error guardando caché de disponibilidad: {e}")
+
+async def invalidate_availability_cache(employee_id):
+    try:
+        # Subir la generación descarta los llenados en curso calculados antes de la escritura
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.incr(availability_generation_key(employee_id))
+            pipe.expire(availability_generation_key(employee_id), AVAILABILITY_CACHE_TTL)
+            pipe.delete(availability_cache_key(employee_id))
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f"Error invalidando caché de disponibilidad: {e}")
+
+async def stream_ndjson(db: AsyncSession, stmt) -> StreamingResponse:
+    """Cursor del lado del servidor: memoria constante, una línea NDJSON por fila"""
+    result = await db.stream(stmt.execution_options(yield_per=500))
+    
+    async def generate():
+        async for row in result:
+            yield orjson.dumps(dict(row._mapping)) + b"\n"
     
-    return f"EMP{year}{new_number:04d}"
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+def validate_date_range(date_from: date, date_to: date):
+    if date_to < date_from:
+        raise HTTPException(status_code=400, detail="date_to debe ser posterior a date_from")
+    if (date_to - date_from).days >= MAX_AVAILABILITY_RANGE_DAYS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"El rango no puede superar {MAX_AVAILABILITY_RANGE_DAYS} días"
+        )
 
 # ENDPOINTS
 
@@ -294,43 +553,19 @@ async def health_check():
 @app.post("/employees", response_model=EmployeeResponse)
 async def create_employee(
     employee: EmployeeCreate,
-    db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(require_admin)
 ):
     """Crear nuevo empleado"""
-    check_admin_permission(current_user)
-    
-    # Verificar que no existe empleado con ese documento
-    existing_employee = db.query(Employee).filter(
-        Employee.document_number == employee.document_number
-    ).first()
-    
-    if existing_employee:
-        raise HTTPException(
-            status_code=400,
-            detail="Ya existe un empleado con ese número de documento"
-        )
     
-    # Verificar email único
-    existing_email = db.query(Employee).filter(Employee.email == employee.email).first()
-    if existing_email:
-        raise HTTPException(
-            status_code=400,
-            detail="Ya existe un empleado con ese email"
-        )
-    
-    # Generar código de empleado
-    employee_code = generate_employee_code(db)
-    
-    # Crear empleado
+    # Crear empleado (documento, email y usuario duplicados los rechaza la DB)
     db_employee = Employee(
         user_id=employee.user_id,
-        employee_code=employee_code,
         full_name=employee.full_name,
         document_number=employee.document_number,
         phone=employee.phone,
         email=employee.email,
-        roles=json.dumps(employee.roles),  # Almacenar como JSON string
+        roles=[r.value for r in employee.roles],
         specialization=employee.specialization,
         license_number=employee.license_number,
         hire_date=employee.hire_date,
@@ -341,148 +576,118 @@ async def create_employee(
     )
     
     db.add(db_employee)
-    db.commit()
-    db.refresh(db_employee)
-    
-    # Convertir roles de JSON a lista para la respuesta
-    response = EmployeeResponse.from_orm(db_employee)
-    response.roles = json.loads(db_employee.roles)
+    await commit_or_conflict(db)
+    await db.refresh(db_employee)
     
-    return response
+    return EmployeeResponse.model_validate(db_employee)
 
 @app.get("/employees", response_model=List[EmployeeResponse])
 async def get_employees(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user),
     skip: int = Query(0, ge=0),
     limit: int = Query(50, le=100),
     role: Optional[EmployeeRole] = None,
     department: Optional[str] = None,
     is_active: Optional[bool] = None,
-    search: Optional[str] = None
+    search: Optional[str] = None,
+    stream: bool = Query(False)
 ):
-    """Obtener lista de empleados con filtros"""
-    query = db.query(Employee)
+    """Obtener lista de empleados con filtros (con stream=true, todos desde skip en NDJSON)"""
+    query = select(*EMPLOYEE_RESPONSE_COLUMNS)
     
     if is_active is not None:
-        query = query.filter(Employee.is_active == is_active)
+        query = query.where(Employee.is_active == is_active)
     
     if role:
-        # Buscar en el JSON de roles
-        query = query.filter(Employee.roles.contains(role))
+        query = query.where(Employee.roles.contains([role.value]))
     
     if department:
-        query = query.filter(Employee.department.ilike(f"%{department}%"))
+        query = query.where(Employee.department.ilike(f"%{department}%"))
     
     if search:
-        search_pattern = f"%{search}%"
-        query = query.filter(
-            (Employee.full_name.ilike(search_pattern)) |
-            (Employee.employee_code.ilike(search_pattern)) |
-            (Employee.document_number.ilike(search_pattern)) |
-            (Employee.email.ilike(search_pattern))
-        )
+        # Palabras completas por FTS; fragmentos del nombre por el índice trigram
+        query = query.where(or_(
+            Employee.search_vector.op('@@')(func.plainto_tsquery('simple', search)),
+            Employee.full_name.ilike(f"%{search}%")
+        ))
     
-    employees = query.order_by(Employee.created_at.desc()).offset(skip).limit(limit).all()
+    query = query.order_by(Employee.created_at.desc()).offset(skip)
+    if stream:
+        return await stream_ndjson(db, query)
     
-    # Convertir roles de JSON a lista para cada empleado
-    response_list = []
-    for emp in employees:
-        emp_response = EmployeeResponse.from_orm(emp)
-        emp_response.roles = json.loads(emp.roles) if emp.roles else []
-        response_list.append(emp_response)
+    rows = (await db.execute(query.limit(limit))).all()
     
-    return response_list
+    # Filas ya tipadas por la DB: construir sin revalidar
+    return [EmployeeResponse.model_construct(**row._mapping) for row in rows]
 
 @app.get("/employees/{employee_id}", response_model=EmployeeResponse)
 async def get_employee(
     employee_id: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
     """Obtener empleado específico"""
-    employee = db.query(Employee).filter(
+    employee = (await db.execute(select(Employee).where(
         Employee.id == employee_id,
         Employee.is_active == True
-    ).first()
+    ))).scalars().first()
     
     if not employee:
         raise HTTPException(status_code=404, detail="Empleado no encontrado")
     
-    response = EmployeeResponse.from_orm(employee)
-    response.roles = json.loads(employee.roles) if employee.roles else []
-    
-    return response
+    return EmployeeResponse.model_validate(employee)
 
 @app.put("/employees/{employee_id}", response_model=EmployeeResponse)
 async def update_employee(
     employee_id: str,
     employee_update: EmployeeUpdate,
-    db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(require_admin)
 ):
     """Actualizar empleado"""
-    check_admin_permission(current_user)
     
-    db_employee = db.query(Employee).filter(
+    db_employee = (await db.execute(select(Employee).where(
         Employee.id == employee_id,
         Employee.is_active == True
-    ).first()
+    ))).scalars().first()
     
     if not db_employee:
         raise HTTPException(status_code=404, detail="Empleado no encontrado")
     
-    # Verificar email único si se está actualizando
-    if employee_update.email and employee_update.email != db_employee.email:
-        existing_email = db.query(Employee).filter(
-            Employee.email == employee_update.email,
-            Employee.id != employee_id
-        ).first()
-        if existing_email:
-            raise HTTPException(
-                status_code=400,
-                detail="Ya existe un empleado con ese email"
-            )
-    
     # Actualizar campos
-    update_data = employee_update.dict(exclude_unset=True)
+    update_data = employee_update.model_dump(exclude_unset=True)
     for field, value in update_data.items():
         if field == 'roles':
-            # Convertir lista de roles a JSON string
-            setattr(db_employee, field, json.dumps(value))
-        else:
-            setattr(db_employee, field, value)
+            value = [r.value for r in value]
+        setattr(db_employee, field, value)
     
     db_employee.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(db_employee)
-    
-    response = EmployeeResponse.from_orm(db_employee)
-    response.roles = json.loads(db_employee.roles) if db_employee.roles else []
+    await commit_or_conflict(db)
+    await db.refresh(db_employee)
     
-    return response
+    return EmployeeResponse.model_validate(db_employee)
 
 @app.delete("/employees/{employee_id}")
 async def deactivate_employee(
     employee_id: str,
-    db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(require_admin)
 ):
     """Desactivar empleado (soft delete)"""
-    check_admin_permission(current_user)
     
-    db_employee = db.query(Employee).filter(
-        Employee.id == employee_id,
-        Employee.is_active == True
-    ).first()
+    # Soft delete en una sola sentencia; sin fila devuelta no existía o ya estaba inactivo
+    deactivated = (await db.execute(
+        update(Employee).where(
+            Employee.id == employee_id,
+            Employee.is_active == True
+        ).values(is_active=False, updated_at=datetime.utcnow()).returning(Employee.id)
+    )).scalar()
     
-    if not db_employee:
+    if not deactivated:
         raise HTTPException(status_code=404, detail="Empleado no encontrado")
     
-    # Soft delete
-    db_employee.is_active = False
-    db_employee.updated_at = datetime.utcnow()
-    db.commit()
+    await db.commit()
     
     return {"message": "Empleado desactivado exitosamente"}
 
@@ -492,35 +697,21 @@ async def deactivate_employee(
 async def create_work_schedule(
     employee_id: str,
     schedule: WorkScheduleCreate,
-    db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(require_admin)
 ):
     """Crear horario de trabajo para empleado"""
-    check_admin_permission(current_user)
     
     # Verificar que existe el empleado
-    employee = db.query(Employee).filter(
+    employee = (await db.execute(select(Employee).where(
         Employee.id == employee_id,
         Employee.is_active == True
-    ).first()
+    ))).scalars().first()
     
     if not employee:
         raise HTTPException(status_code=404, detail="Empleado no encontrado")
     
-    # Verificar que no existe horario para ese día
-    existing_schedule = db.query(WorkSchedule).filter(
-        WorkSchedule.employee_id == employee_id,
-        WorkSchedule.day_of_week == schedule.day_of_week,
-        WorkSchedule.is_active == True
-    ).first()
-    
-    if existing_schedule:
-        raise HTTPException(
-            status_code=400,
-            detail="Ya existe un horario para ese día. Use actualizar para modificarlo."
-        )
-    
-    # Crear horario
+    # Crear horario (un segundo horario activo para el mismo día lo rechaza la DB)
     db_schedule = WorkSchedule(
         employee_id=employee_id,
         day_of_week=schedule.day_of_week,
@@ -531,74 +722,124 @@ async def create_work_schedule(
     )
     
     db.add(db_schedule)
-    db.commit()
-    db.refresh(db_schedule)
+    await commit_or_conflict(db)
+    await invalidate_availability_cache(employee.id)
+    await db.refresh(db_schedule)
+    
+    return WorkScheduleResponse.model_validate(db_schedule)
+
+@app.put("/employees/{employee_id}/schedules", response_model=List[WorkScheduleResponse])
+async def upsert_work_schedules(
+    employee_id: uuid.UUID,
+    schedules: List[WorkScheduleDay],
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(require_admin)
+):
+    """Crear o reemplazar varios días del horario semanal en una sola sentencia"""
+    
+    if not schedules:
+        raise HTTPException(status_code=400, detail="Debe enviar al menos un horario")
+    if len({s.day_of_week for s in schedules}) != len(schedules):
+        raise HTTPException(status_code=400, detail="Hay días repetidos en los horarios")
+    
+    # Verificar que existe el empleado
+    employee = (await db.execute(select(Employee.id).where(
+        Employee.id == employee_id,
+        Employee.is_active == True
+    ))).scalar()
+    
+    if not employee:
+        raise HTTPException(status_code=404, detail="Empleado no encontrado")
+    
+    stmt = pg_insert(WorkSchedule).values([
+        {"employee_id": employee_id, **schedule.model_dump()} for schedule in schedules
+    ])
+    # El horario activo del día se actualiza en sitio (índice único parcial uq_ws_emp_day_active)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[WorkSchedule.employee_id, WorkSchedule.day_of_week],
+        index_where=WorkSchedule.is_active,
+        set_={
+            "start_time": stmt.excluded.start_time,
+            "end_time": stmt.excluded.end_time,
+            "break_start": stmt.excluded.break_start,
+            "break_end": stmt.excluded.break_end
+        }
+    ).returning(WorkSchedule)
     
-    return WorkScheduleResponse.from_orm(db_schedule)
+    db_schedules = (await db.execute(stmt)).scalars().all()
+    await db.commit()
+    await invalidate_availability_cache(employee_id)
+    
+    return sorted(
+        (WorkScheduleResponse.model_validate(schedule) for schedule in db_schedules),
+        key=lambda schedule: schedule.day_of_week
+    )
 
 @app.get("/employees/{employee_id}/schedules", response_model=List[WorkScheduleResponse])
 async def get_employee_schedules(
     employee_id: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
     """Obtener horarios de trabajo del empleado"""
-    schedules = db.query(WorkSchedule).filter(
+    schedules = (await db.execute(select(WorkSchedule).where(
         WorkSchedule.employee_id == employee_id,
         WorkSchedule.is_active == True
-    ).order_by(WorkSchedule.day_of_week).all()
+    ).order_by(WorkSchedule.day_of_week))).scalars().all()
     
-    return [WorkScheduleResponse.from_orm(schedule) for schedule in schedules]
+    return [WorkScheduleResponse.model_validate(schedule) for schedule in schedules]
 
 @app.put("/schedules/{schedule_id}", response_model=WorkScheduleResponse)
 async def update_work_schedule(
     schedule_id: str,
     schedule_update: WorkScheduleCreate,
-    db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(require_admin)
 ):
     """Actualizar horario de trabajo"""
-    check_admin_permission(current_user)
     
-    db_schedule = db.query(WorkSchedule).filter(
-        WorkSchedule.id == schedule_id,
-        WorkSchedule.is_active == True
-    ).first()
+    # Actualizar campos y devolver la fila en el mismo viaje
+    db_schedule = (await db.execute(
+        update(WorkSchedule).where(
+            WorkSchedule.id == schedule_id,
+            WorkSchedule.is_active == True
+        ).values(
+            start_time=schedule_update.start_time,
+            end_time=schedule_update.end_time,
+            break_start=schedule_update.break_start,
+            break_end=schedule_update.break_end
+        ).returning(WorkSchedule)
+    )).scalars().first()
     
     if not db_schedule:
         raise HTTPException(status_code=404, detail="Horario no encontrado")
     
-    # Actualizar campos
-    db_schedule.start_time = schedule_update.start_time
-    db_schedule.end_time = schedule_update.end_time
-    db_schedule.break_start = schedule_update.break_start
-    db_schedule.break_end = schedule_update.break_end
-    
-    db.commit()
-    db.refresh(db_schedule)
+    await db.commit()
+    await invalidate_availability_cache(db_schedule.employee_id)
     
-    return WorkScheduleResponse.from_orm(db_schedule)
+    return WorkScheduleResponse.model_validate(db_schedule)
 
 @app.delete("/schedules/{schedule_id}")
 async def delete_work_schedule(
     schedule_id: str,
-    db: Session = Depends(get_db),
-    current_user = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(require_admin)
 ):
     """Eliminar horario de trabajo"""
-    check_admin_permission(current_user)
-    
-    db_schedule = db.query(WorkSchedule).filter(
-        WorkSchedule.id == schedule_id,
-        WorkSchedule.is_active == True
-    ).first()
     
-    if not db_schedule:
+    # Soft delete
+    employee_id = (await db.execute(
+        update(WorkSchedule).where(
+            WorkSchedule.id == schedule_id,
+            WorkSchedule.is_active == True
+        ).values(is_active=False).returning(WorkSchedule.employee_id)
+    )).scalar()
+    
+    if not employee_id:
         raise HTTPException(status_code=404, detail="Horario no encontrado")
     
-    # Soft delete
-    db_schedule.is_active = False
-    db.commit()
+    await db.commit()
+    await invalidate_availability_cache(employee_id)
     
     return {"message": "Horario eliminado exitosamente"}
 
@@ -608,15 +849,15 @@ async def delete_work_schedule(
 async def create_availability(
     employee_id: str,
     availability: AvailabilityCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
     """Crear disponibilidad específica (vacaciones, permisos, etc.)"""
     # Verificar que existe el empleado
-    employee = db.query(Employee).filter(
+    employee = (await db.execute(select(Employee).where(
         Employee.id == employee_id,
         Employee.is_active == True
-    ).first()
+    ))).scalars().first()
     
     if not employee:
         raise HTTPException(status_code=404, detail="Empleado no encontrado")
@@ -640,105 +881,171 @@ async def create_availability(
     )
     
     db.add(db_availability)
-    db.commit()
-    db.refresh(db_availability)
+    await db.commit()
+    await invalidate_availability_cache(employee.id)
+    await db.refresh(db_availability)
     
-    return AvailabilityResponse.from_orm(db_availability)
+    return AvailabilityResponse.model_validate(db_availability)
 
 @app.get("/employees/{employee_id}/availability")
 async def get_employee_availability(
     employee_id: str,
-    db: Session = Depends(get_db),
+    date_from: date,
+    date_to: date,
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user),
-    date_from: Optional[date] = None,
-    date_to: Optional[date] = None
+    group_by: Optional[Literal["week"]] = None,
+    stream: bool = Query(False)
 ):
-    """Obtener disponibilidad del empleado"""
-    query = db.query(EmployeeAvailability).filter(
-        EmployeeAvailability.employee_id == employee_id
-    )
-    
-    if date_from:
-        query = query.filter(EmployeeAvailability.date >= date_from)
-    
-    if date_to:
-        query = query.filter(EmployeeAvailability.date <= date_to)
+    """Obtener disponibilidad del empleado en un rango (máximo MAX_AVAILABILITY_RANGE_DAYS días)"""
+    validate_date_range(date_from, date_to)
     
-    availability = query.order_by(EmployeeAvailability.date).all()
+    in_range = (
+        EmployeeAvailability.employee_id == employee_id,
+        EmployeeAvailability.date.between(date_from, date_to)
+    )
     
-    return [AvailabilityResponse.from_orm(av) for av in availability]
+    if group_by == "week":
+        # Resumen por semana calculado en la DB: una fila por semana, no por día
+        week = cast(func.date_trunc('week', EmployeeAvailability.date), Date).label("week_start")
+        rows = (await db.execute(
+            select(
+                week,
+                func.count().label("entries"),
+                func.bool_or(EmployeeAvailability.is_available).label("has_available"),
+                func.bool_or(EmployeeAvailability.is_available == False).label("has_unavailable")
+            ).where(*in_range).group_by(week).order_by(week)
+        )).all()
+        return [dict(row._mapping) for row in rows]
+    
+    query = select(*AVAILABILITY_RESPONSE_COLUMNS).where(*in_range).order_by(EmployeeAvailability.date)
+    if stream:
+        return await stream_ndjson(db, query)
+    
+    rows = (await db.execute(query)).all()
+    
+    return [AvailabilityResponse.model_construct(**row._mapping) for row in rows]
 
 # ENDPOINTS DE VETERINARIOS (para el servicio de citas)
 
 @app.get("/veterinarians", response_model=List[EmployeeResponse])
 async def get_veterinarians(
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
     """Obtener lista de veterinarios activos"""
-    veterinarians = db.query(Employee).filter(
+    is_veterinarian = (
         Employee.is_active == True,
-        Employee.roles.contains('"veterinarian"')  # Buscar en JSON
-    ).all()
+        Employee.roles.contains([EmployeeRole.veterinarian.value])
+    )
+    
+    # La lista cambia poco: versión barata (última modificación + total) como ETag
+    last_update, total = (await db.execute(
+        select(func.max(Employee.updated_at), func.count()).where(*is_veterinarian)
+    )).one()
+    etag = '"' + hashlib.md5(f"{last_update}|{total}".encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=30"}
+    
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    response.headers.update(headers)
+    veterinarians = (await db.execute(select(Employee).where(*is_veterinarian))).scalars().all()
+    
+    return [EmployeeResponse.model_validate(vet) for vet in veterinarians]
+
+@app.post("/veterinarians/availability")
+async def get_veterinarians_availability(
+    batch: AvailabilityBatchRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """Disponibilidad de varios empleados en un rango: {employee_id: {fecha: disponibilidad}}"""
+    validate_date_range(batch.date_from, batch.date_to)
+    
+    schedules, availability = await fetch_schedules_and_availability(
+        db, batch.employee_ids, batch.date_from, batch.date_to
+    )
     
-    # Convertir roles de JSON a lista
-    response_list = []
-    for vet in veterinarians:
-        vet_response = EmployeeResponse.from_orm(vet)
-        vet_response.roles = json.loads(vet.roles) if vet.roles else []
-        response_list.append(vet_response)
+    matrix = {}
+    for employee_id in map(str, batch.employee_ids):
+        days = {}
+        day = batch.date_from
+        while day <= batch.date_to:
+            days[day.isoformat()] = build_day_availability(
+                day,
+                schedules.get((employee_id, day.weekday())),
+                availability.get((employee_id, day))
+            )
+            day += timedelta(days=1)
+        matrix[employee_id] = days
     
-    return response_list
+    return matrix
 
 @app.get("/employees/{employee_id}/availability/{date}")
 async def check_employee_availability_date(
-    employee_id: str,
+    employee_id: uuid.UUID,
     date: date,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
     """Verificar disponibilidad de empleado en fecha específica"""
-    # Obtener horario regular del empleado
+    cached, generation = await get_cached_day_availability(employee_id, date)
+    if cached:
+        return cached
+    
     day_of_week = date.weekday()  # 0=Lunes, 6=Domingo
     
-    regular_schedule = db.query(WorkSchedule).filter(
+    # Horario regular y disponibilidad específica en una sola consulta
+    regular = aliased(WorkSchedule, select(WorkSchedule).where(
         WorkSchedule.employee_id == employee_id,
         WorkSchedule.day_of_week == day_of_week,
         WorkSchedule.is_active == True
-    ).first()
-    
-    # Obtener disponibilidad específica para esa fecha
-    specific_availability = db.query(EmployeeAvailability).filter(
+    ).limit(1).subquery())
+    specific = aliased(EmployeeAvailability, select(EmployeeAvailability).where(
         EmployeeAvailability.employee_id == employee_id,
         EmployeeAvailability.date == date
-    ).first()
+    ).limit(1).subquery())
+    anchor = select(literal(1).label("anchor")).subquery()
     
-    if specific_availability:
-        # Si hay disponibilidad específica, usar esa
-        return {
-            "date": date,
-            "is_available": specific_availability.is_available,
-            "start_time": specific_availability.start_time if specific_availability.is_available else None,
-            "end_time": specific_availability.end_time if specific_availability.is_available else None,
-            "reason": specific_availability.reason
-        }
-    elif regular_schedule:
-        # Si no hay disponibilidad específica, usar horario regular
-        return {
-            "date": date,
-            "is_available": True,
-            "start_time": regular_schedule.start_time,
-            "end_time": regular_schedule.end_time,
-            "break_start": regular_schedule.break_start,
-            "break_end": regular_schedule.break_end
-        }
-    else:
-        # No hay horario para ese día
-        return {
-            "date": date,
-            "is_available": False,
-            "reason": "No hay horario asignado para este día"
-        }
+    regular_schedule, specific_availability = (await db.execute(
+        select(regular, specific).select_from(anchor)
+        .outerjoin(regular, true())
+        .outerjoin(specific, true())
+    )).one()
+    
+    day_availability = build_day_availability(date, regular_schedule, specific_availability)
+    await cache_day_availability(employee_id, date, day_availability, generation)
+    
+    return day_availability
+
+@app.get("/employees/{employee_id}/calendar")
+async def get_employee_calendar(
+    employee_id: uuid.UUID,
+    date_from: date,
+    date_to: date,
+    db: AsyncSession = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """Disponibilidad día por día de un empleado en un rango de fechas"""
+    validate_date_range(date_from, date_to)
+    
+    schedules, availability = await fetch_schedules_and_availability(db, [employee_id], date_from, date_to)
+    employee_key = str(employee_id)
+    
+    days = []
+    day = date_from
+    while day <= date_to:
+        days.append(build_day_availability(
+            day,
+            schedules.get((employee_key, day.weekday())),
+            availability.get((employee_key, day))
+        ))
+        day += timedelta(days=1)
+    
+    return days
 
 if __name__ == "__main__":
     import uvicorn
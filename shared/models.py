@@ -1,9 +1,23 @@
 # shared/models.py - Modelos base compartidos
 from django.db import models
+from django.db.models import Count, F, Func, Prefetch, Q
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
 from django.core.validators import RegexValidator
+from django.utils import timezone
+from datetime import timedelta
+from decimal import Decimal
+from functools import cached_property
 import uuid
 
+def to_cents(amount):
+    """Decimal/str/int en pesos -> entero en centavos"""
+    return int((Decimal(str(amount)) * 100).to_integral_value())
+
 class BaseModel(models.Model):
     """Modelo base con campos comunes"""
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -67,6 +81,23 @@ class Client(BaseModel):
         verbose_name_plural = 'Clientes'
 
 
+class PetQuerySet(models.QuerySet):
+    def with_age_months(self):
+        """Anota age_months calculada en SQL, con la misma regla que current_age_months"""
+        return self.annotate(age_months=Coalesce(
+            Func(F('birth_date'), template='((CURRENT_DATE - %(expressions)s) / 30)',
+                 output_field=models.IntegerField()),
+            F('estimated_age_months')
+        ))
+    
+    def younger_than_months(self, months):
+        """Mascotas con menos de `months` meses, filtrando por birth_date (indexado)"""
+        limit = timezone.now().date() - timedelta(days=30 * months)
+        return self.filter(
+            Q(birth_date__gt=limit) |
+            Q(birth_date__isnull=True, estimated_age_months__lt=months)
+        )
+
 class Pet(BaseModel):
     """Mascotas"""
     SPECIES_CHOICES = [
@@ -102,13 +133,15 @@ class Pet(BaseModel):
     observations = models.TextField(blank=True)
     photo = models.URLField(blank=True)  # URL de la foto almacenada
     
+    objects = PetQuerySet.as_manager()
+    
     def __str__(self):
         return f"{self.name} ({self.get_species_display()}) - {self.owner.full_name}"
     
     @property
     def current_age_months(self):
+        # Para listados usar Pet.objects.with_age_months() y leer age_months
         if self.birth_date:
-            from django.utils import timezone
             today = timezone.now().date()
             return (today - self.birth_date).days // 30
         return self.estimated_age_months
@@ -117,12 +150,35 @@ class Pet(BaseModel):
         db_table = 'pets'
         verbose_name = 'Mascota'
         verbose_name_plural = 'Mascotas'
+        indexes = [
+            models.Index(fields=['birth_date'], name='pet_birth_date_idx'),
+        ]
 
 
 # =============================================================================
 # EMPLOYEES SERVICE MODELS
 # =============================================================================
 
+class EmployeeQuerySet(models.QuerySet):
+    def with_role(self, role):
+        """Empleados con el rol dado, filtrando en la DB (usa emp_roles_gin)"""
+        if role == 'veterinarian':
+            return self.filter(is_vet=True)
+        return self.filter(roles__contains=[role])
+    
+    def for_list(self):
+        """Solo las columnas de los listados; el detalle usa el queryset completo"""
+        return self.only('id', 'employee_code', 'full_name', 'email', 'phone', 'roles', 'hire_date', 'is_active')
+    
+    def prefetch_week(self):
+        """Precarga los horarios ordenados por día en `employee.week` (una consulta extra en total)"""
+        return self.prefetch_related(Prefetch(
+            'schedules',
+            # El empleado ya viene del lado padre: sin el JOIN del manager por defecto
+            queryset=WorkSchedule.objects.select_related(None).order_by('day_of_week'),
+            to_attr='week'
+        ))
+
 class Employee(BaseModel):
     """Empleados de la clínica"""
     ROLES = [
@@ -134,32 +190,85 @@ class Employee(BaseModel):
     ]
     
     user_id = models.UUIDField(unique=True)  # Referencia al usuario
-    employee_code = models.CharField(max_length=20, unique=True)
+    # Códigos opacos ASCII: collation 'C' compara bytes en vez de reglas del locale
+    employee_code = models.CharField(max_length=20, unique=True, db_collation='C')
     full_name = models.CharField(max_length=200)
-    document_number = models.CharField(max_length=20, unique=True)
+    document_number = models.CharField(max_length=20, unique=True, db_collation='C')
     phone = models.CharField(max_length=15)
     email = models.EmailField()
-    roles = models.JSONField(default=list)  # Lista de roles
+    roles = ArrayField(models.CharField(max_length=20, choices=ROLES), default=list)  # Lista de roles
     specialization = models.CharField(max_length=200, blank=True)  # Para veterinarios
     license_number = models.CharField(max_length=50, blank=True)  # Tarjeta profesional
     hire_date = models.DateField()
-    salary = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    salary_cents = models.BigIntegerField(null=True, blank=True)  # Montos en centavos
+    # Rol más consultado, desnormalizado para filtrar con un índice parcial
+    is_vet = models.GeneratedField(
+        expression=Q(roles__contains=['veterinarian']),
+        output_field=models.BooleanField(),
+        db_persist=True
+    )
+    
+    objects = EmployeeQuerySet.as_manager()
     
     def __str__(self):
         return f"{self.full_name} - {self.employee_code}"
     
+    @classmethod
+    def vet_hires_by_year(cls):
+        """{año: veterinarios contratados}, agregado en la DB"""
+        return dict(
+            cls.objects.with_role('veterinarian')
+            .values_list('hire_date__year')
+            .annotate(n=Count('id'))
+            .order_by()
+        )
+    
+    @property
+    def salary(self):
+        if self.salary_cents is None:
+            return None
+        return Decimal(self.salary_cents).scaleb(-2)
+    
+    @salary.setter
+    def salary(self, value):
+        self.salary_cents = None if value is None else to_cents(value)
+    
+    @cached_property
+    def _roles_set(self):
+        return frozenset(self.roles or [])
+    
     def has_role(self, role):
-        return role in self.roles
+        # Solo para una instancia ya cargada; para filtrar usar Employee.objects.with_role()
+        return role in _ROLE_KEYS and role in self._roles_set
     
+    @cached_property
     def is_veterinarian(self):
-        return 'veterinarian' in self.roles
+        if 'is_vet' in self.__dict__:
+            return self.is_vet
+        return 'veterinarian' in self._roles_set
     
     class Meta:
         db_table = 'employees'
         verbose_name = 'Empleado'
         verbose_name_plural = 'Empleados'
+        ordering = ['full_name']
+        indexes = [
+            models.Index(fields=['full_name'], name='emp_full_name_idx'),
+            GinIndex(fields=['roles'], opclasses=['array_ops'], name='emp_roles_gin'),
+            models.Index(fields=['email'], name='emp_email_idx'),
+            models.Index(fields=['hire_date'], name='emp_hire_idx'),
+            models.Index(fields=['is_vet'], condition=Q(is_vet=True), name='emp_is_vet_idx'),
+        ]
+
+
+_ROLE_KEYS = frozenset(key for key, _ in Employee.ROLES)
 
 
+class WorkScheduleManager(models.Manager):
+    def get_queryset(self):
+        # Casi todo acceso a un horario lee schedule.employee: un JOIN en vez de N consultas
+        return super().get_queryset().select_related('employee')
+
 class WorkSchedule(BaseModel):
     """Horarios de trabajo de empleados"""
     DAYS_OF_WEEK = [
@@ -173,21 +282,57 @@ class WorkSchedule(BaseModel):
     ]
     
     employee = models.ForeignKey(Employee, on_delete=models.CASCADE, related_name='schedules')
-    day_of_week = models.IntegerField(choices=DAYS_OF_WEEK)
+    day_of_week = models.PositiveSmallIntegerField(choices=DAYS_OF_WEEK)
     start_time = models.TimeField()
     end_time = models.TimeField()
     break_start = models.TimeField(null=True, blank=True)
     break_end = models.TimeField(null=True, blank=True)
     
+    objects = WorkScheduleManager()
+    
+    @classmethod
+    def bulk_seed_week(cls, employee, schedule_dicts):
+        """Crea los horarios de la semana en un solo INSERT; omite días ya existentes"""
+        return cls.objects.bulk_create(
+            [cls(employee=employee, **d) for d in schedule_dicts],
+            batch_size=500, ignore_conflicts=True
+        )
+    
     class Meta:
         db_table = 'work_schedules'
-        unique_together = ['employee', 'day_of_week']
+        constraints = [
+            # Cubre la consulta de horario del día: index-only scan sin tocar la tabla
+            models.UniqueConstraint(
+                fields=['employee', 'day_of_week'],
+                include=['start_time', 'end_time', 'break_start', 'break_end'],
+                name='ws_emp_dow_uniq'
+            ),
+            models.CheckConstraint(
+                check=Q(start_time__lt=F('end_time')) &
+                      (Q(break_start__isnull=True) | Q(break_start__gte=F('start_time'))) &
+                      (Q(break_start__isnull=True) | Q(break_end__isnull=True) |
+                       Q(break_start__lt=F('break_end'), break_end__lte=F('end_time'))),
+                name='ws_valid_range'
+            ),
+        ]
 
 
 # =============================================================================
 # SERVICES MODELS (Shared between appointments and billing)
 # =============================================================================
 
+_SERVICE_LIST_FIELDS = (
+    'id', 'name', 'service_type', 'base_price_cents',
+    'estimated_duration_minutes', 'requires_appointment'
+)
+CATALOG_VERSION_KEY = 'vet_svc_v'
+CATALOG_CACHE_TTL = 3600
+
+class VeterinaryServiceQuerySet(models.QuerySet):
+    def for_list(self):
+        """Catálogo sin los campos de texto largos (description, preparation_instructions)"""
+        return self.only(*_SERVICE_LIST_FIELDS)
+
 class VeterinaryService(BaseModel):
     """Servicios veterinarios disponibles"""
     SERVICE_TYPES = [
@@ -206,17 +351,76 @@ class VeterinaryService(BaseModel):
     name = models.CharField(max_length=200)
     service_type = models.CharField(max_length=20, choices=SERVICE_TYPES)
     description = models.TextField()
-    base_price = models.DecimalField(max_digits=10, decimal_places=2)
-    estimated_duration_minutes = models.IntegerField()
+    base_price_cents = models.BigIntegerField()  # Para agregados usar Sum('base_price_cents')
+    estimated_duration_minutes = models.PositiveSmallIntegerField()
     requires_appointment = models.BooleanField(default=True)
-    available_for_species = models.JSONField(default=list)  # Lista de especies
+    available_for_species = ArrayField(
+        models.CharField(max_length=20, choices=Pet.SPECIES_CHOICES), default=list
+    )  # Lista de especies
     requires_fasting = models.BooleanField(default=False)
     preparation_instructions = models.TextField(blank=True)
     
+    objects = VeterinaryServiceQuerySet.as_manager()
+    
     def __str__(self):
         return f"{self.name} - ${self.base_price}"
     
+    @property
+    def base_price(self):
+        return Decimal(self.base_price_cents).scaleb(-2)
+    
+    @base_price.setter
+    def base_price(self, value):
+        self.base_price_cents = to_cents(value)
+    
+    @classmethod
+    def bulk_seed(cls, service_dicts):
+        """Carga el catálogo de servicios en un solo INSERT"""
+        service_dicts = list(service_dicts)
+        # bulk_create no valida choices: rechazar tipos desconocidos antes de insertar
+        unknown = {d.get('service_type') for d in service_dicts} - _SERVICE_TYPE_KEYS
+        if unknown:
+            raise ValueError(f"Tipos de servicio inválidos: {sorted(map(str, unknown))}")
+        services = cls.objects.bulk_create(
+            [cls(**d) for d in service_dicts],
+            batch_size=500, ignore_conflicts=True
+        )
+        # bulk_create no emite post_save
+        bump_catalog_version()
+        return services
+    
+    @classmethod
+    def catalog(cls):
+        """Servicios activos para formularios; cacheado hasta que cambie el catálogo"""
+        version = cache.get(CATALOG_VERSION_KEY, 0)
+        key = f'vet_svc_{version}'
+        data = cache.get(key)
+        if data is None:
+            data = list(cls.objects.filter(is_active=True).values(*_SERVICE_LIST_FIELDS))
+            cache.set(key, data, CATALOG_CACHE_TTL)
+        return data
+    
     class Meta:
         db_table = 'veterinary_services'
         verbose_name = 'Servicio Veterinario'
-        verbose_name_plural = 'Servicios Veterinarios'
\ No newline at end of file
+        verbose_name_plural = 'Servicios Veterinarios'
+        ordering = ['service_type', 'name']
+        indexes = [
+            models.Index(fields=['service_type', 'name'], name='svc_type_name_idx'),
+            models.Index(fields=['service_type', 'requires_appointment'], name='svc_type_appt_idx'),
+            GinIndex(fields=['available_for_species'], name='svc_species_gin'),
+        ]
+
+
+_SERVICE_TYPE_KEYS = frozenset(key for key, _ in VeterinaryService.SERVICE_TYPES)
+
+
+def bump_catalog_version(**kwargs):
+    """Invalida VeterinaryService.catalog(); los update() masivos deben llamarla a mano"""
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.set(CATALOG_VERSION_KEY, 1, None)
+
+post_save.connect(bump_catalog_version, sender=VeterinaryService)
+post_delete.connect(bump_catalog_version, sender=VeterinaryService)